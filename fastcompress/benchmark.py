@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for Fast Compress.
+
+Run everything:
+
+ $ python benchmark.py
+
+Or just some of it:
+
+ $ python benchmark.py chunks
+
+Each benchmark runs in a fresh interpreter, so NumPy is only loaded where fc
+itself would load it.
+"""
+
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import fc
+
+
+def random_text(size, alphabet=string.ascii_letters + string.digits + ' \n'):
+    """Return a reproducible random ASCII string of the given size."""
+    rng = random.Random(size)
+    return "".join(rng.choice(alphabet) for _ in range(size))
+
+
+def best_of(func, repeat=5, number=1):
+    """Return the best time of a few runs of func, in seconds."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def _compressed_with_chunks(count):
+    """Return s_compress output whose head holds about count chunks."""
+    # Random chunking takes a chunk every few characters, so search for the
+    # shortest input that fills the head that far.
+    rng = random.Random(count)
+    text = "".join(rng.choice(string.ascii_letters + ' \n')
+                   for _ in range(count * 10))
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        random.seed(0)
+        x = fc.s_compress(text[:mid])
+        if x.split('\n', 1)[0].count('/') - 2 < count:
+            lo = mid + 1
+        else:
+            hi = mid
+    random.seed(0)
+    return text[:lo], fc.s_compress(text[:lo])
+
+
+def bench_chunks():
+    """Decompression time against head chunk count."""
+    print("chunks   input  s_decompress (ms)")
+    for count in (10, 50, 100, 250, 500, 997):
+        text, x = _compressed_with_chunks(count)
+        assert fc.s_decompress(x) == text
+        print("%6d  %6d  %17.3f" % (
+            x.split('\n', 1)[0].count('/') - 2, len(text),
+            best_of(lambda: fc.s_decompress(x)) * 1e3))
+
+
+def bench_matrix():
+    """Parsing 10k matrix tokens with eval versus parse_matrices."""
+    import numpy
+
+    rng = random.Random(0)
+    key = [[rng.randint(1, 3) for _ in range(3)] for _ in range(3)]
+    tokens = [
+        repr(fc.matmul([[rng.randint(32, 127), 0, 0], [1, 2, 3], [3, 2, 1]],
+                       key))
+        for _ in range(10000)
+        ]
+    t_eval = best_of(lambda: numpy.array([eval(m) for m in tokens]))
+    t_parse = best_of(lambda: fc.parse_matrices(tokens))
+    print("eval           %8.1f ms" % (t_eval * 1e3))
+    print("parse_matrices %8.1f ms" % (t_parse * 1e3))
+
+
+def bench_compress():
+    """Compression time at the 997-chunk dictionary cap."""
+    random.seed(0)
+    text = random_text(20000)
+    out = fc.s_compress(text)
+    elapsed = best_of(lambda: fc.s_compress(text))
+    head = out.split('\n')[0]
+    print("chunks %d, s_compress %.1f ms" % (
+        head.count('/') - 2, elapsed * 1e3))
+
+
+def bench_encrypt():
+    """s_encrypt against the character loop, extrapolated to 100 MB."""
+    small = random_text(1 << 20)
+    big = small * 100
+    t_loop = best_of(lambda: fc._encrypt_chars(small, '!northbank!'),
+                     repeat=1)
+    t_numpy = best_of(lambda: fc.s_encrypt(big, '!northbank!'), repeat=1)
+    print("character loop  %8.2f s (1 MB x 100)" % (t_loop * 100))
+    print("s_encrypt       %8.2f s (100 MB)" % t_numpy)
+
+
+def bench_dictionary():
+    """Binary format ratio and speed as the dictionary grows."""
+    print("entries    ratio   b_compress  b_decompress")
+    # Sizes of random input that make about 1k, 100k and 1M entries.
+    for size in (4500, 550000, 8500000):
+        text = random.Random(size).randbytes(size)
+        start = timeit.default_timer()
+        out = fc.b_compress(text)
+        t_compress = timeit.default_timer() - start
+        start = timeit.default_timer()
+        fc.b_decompress(out)
+        t_decompress = timeit.default_timer() - start
+
+        # Skip the block length, the key and the matrix key.
+        _, pos = fc._read_varint(out, 3)
+        n, pos = fc._read_varint(out, pos)
+        entries, _ = fc._read_varint(out, pos + n + fc._MATRIX_STRUCT.size)
+        print("%7d  %7.3f  %8.2f MB/s  %8.2f MB/s" % (
+            entries, len(out) / len(text), len(text) / t_compress / 1e6,
+            len(text) / t_decompress / 1e6))
+
+
+def bench_many():
+    """100 small files: one fc process each against compress_many."""
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(100):
+            paths.append(os.path.join(tmp, 'f%d' % i))
+            with open(paths[-1], 'w') as f:
+                f.write(random_text(2000 + i))
+
+        start = timeit.default_timer()
+        for path in paths:
+            subprocess.run([sys.executable, fc.__file__, '--compress', '-k',
+                            path], check=True)
+        t_processes = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        for result in fc.compress_many(paths, force=True):
+            assert result[-1] is None, result
+        t_many = timeit.default_timer() - start
+    print("fc per file     %8.2f s" % t_processes)
+    print("compress_many   %8.2f s" % t_many)
+
+
+def bench_startup():
+    """Cold start: python -X importtime, and fc on a small file."""
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, fc; assert "numpy" not in sys.modules'],
+        cwd=os.path.dirname(fc.__file__), stderr=subprocess.PIPE,
+        universal_newlines=True, check=True).stderr
+    # The last line is fc itself: self and cumulative microseconds.
+    print("import fc       %8.1f ms" % (
+        int(out.splitlines()[-1].split('|')[1]) / 1e3))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'file')
+        with open(path, 'w') as f:
+            f.write(random_text(2000))
+        elapsed = best_of(lambda: subprocess.run(
+            [sys.executable, fc.__file__, '--compress', '-k', '-f', path],
+            check=True))
+    print("fc --compress   %8.1f ms" % (elapsed * 1e3))
+
+
+def bench_memory():
+    """Memory that _compress keeps and peaks at, per byte of 128 kB input."""
+    # Small enough that fc does not import NumPy, which would be counted too.
+    text = random.Random(0).randbytes(1 << 17)
+    for chunking in ('random', 'frequency'):
+        random.seed(0)
+        tracemalloc.start()
+        result = fc._compress(text, chunking, limit=None)
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        print("%-9s  kept %6.1f B/byte, peak %6.1f B/byte" % (
+            chunking, kept / len(text), peak / len(text)))
+
+
+BENCHMARKS = {
+    'chunks': bench_chunks,
+    'compress': bench_compress,
+    'dictionary': bench_dictionary,
+    'encrypt': bench_encrypt,
+    'many': bench_many,
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'matrix': bench_matrix,
+    }
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    if len(names) == 1:
+        print("== %s: %s" % (names[0], BENCHMARKS[names[0]].__doc__))
+        BENCHMARKS[names[0]]()
+    else:
+        # fc uses NumPy once anything has imported it, so give every
+        # benchmark a fresh interpreter, as the command line would have.
+        for name in names:
+            subprocess.run([sys.executable, __file__, name], check=True)
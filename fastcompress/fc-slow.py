@@ -40,9 +40,9 @@ only works on text files. Fast Compress only works with ASCII characters.
 """
 
 import binascii
+import functools
 import random
 import re
-import numpy
 
 def matmul(a, b):
     return [
@@ -51,18 +51,27 @@ def matmul(a, b):
         for r in a
         ]
 
+@functools.lru_cache(maxsize=None)
+def matadj(b):
+    """Return the adjugate and determinant of a 3x3 matrix of tuples."""
+    cof = [
+        [b[(i+1)%3][(j+1)%3] * b[(i+2)%3][(j+2)%3]
+         - b[(i+1)%3][(j+2)%3] * b[(i+2)%3][(j+1)%3]
+         for j in range(3)]
+        for i in range(3)
+        ]
+    det = sum(x * y for x, y in zip(b[0], cof[0]))
+    return [list(col) for col in zip(*cof)], det
+
 def matdiv(c, b):
-    dim = len(b), len(b[0])
-    maxv = 0
-    while True:
-        maxv += 1
-        for i in range(maxv ** 2 * dim[0] * dim[1] + 10):
-            cand = [
-                [random.randint(0, maxv) for _ in range(dim[0])]
-                for _ in range(dim[1])
-                ]
-            if matmul(cand, b) == c:
-                return cand
+    adj, det = matadj(tuple(map(tuple, b)))
+    if det == 0:
+        raise ValueError("matrix encryption key is singular")
+    # c = cand * b, so cand = c * adj(b) / det(b), which must be exact.
+    cand = matmul(c, adj)
+    if any(x % det for row in cand for x in row):
+        raise ValueError("matrix is not a multiple of the encryption key")
+    return [[x // det for x in row] for row in cand]
 
 def s_compress(plaintext):
     """Compress the given string, returning a string."""
@@ -90,10 +99,14 @@ def s_compress(plaintext):
     # For security purposes, next we will have a matrix encryption key.
     # Important letters are compressed by multiplication with this matrix
     # encryptor.
-    m_encryptor = [
-        [random.randint(1, 3) for _ in range(3)]
-        for _ in range(3)
-        ]
+    # It has to be invertible, or nobody could ever decompress the result.
+    while True:
+        m_encryptor = [
+            [random.randint(1, 3) for _ in range(3)]
+            for _ in range(3)
+            ]
+        if matadj(tuple(map(tuple, m_encryptor)))[1] != 0:
+            break
     head.append(repr(m_encryptor) + '/')
 
     # Here is the core of the compression.
@@ -32,18 +32,68 @@ Through the command line, simply:
  Compressing... Done
  See output: file.fc
 
+Input files are removed once they are done, unless --keep is given, and
+existing outputs are only overwritten with --force. With no files, or -, it
+reads stdin and writes stdout:
+
+ $ tar c dir | fc --compress > dir.tar.fc
+
+Or give it whole directories with --recursive. Compressing several files
+shares one process pool between them, and ends with a report of how long each
+file took:
+
+ $ fc --compress --recursive --jobs 4 logs/
+
+Installing the fastcompress package puts fc on the PATH. NumPy is optional:
+when it is installed, it speeds up big inputs.
+
 LIMITATIONS
 -----------
 
-.fc files, at the moment, are text files. Additionally, Fast Compress itself
-only works on text files. Fast Compress only works with ASCII characters.
+.fc files, at the moment, are text files, unless written with --binary.
+Any file can be compressed: files are read as bytes, and text .fc files keep
+each byte as the latin-1 character of the same value.
 
 """
 
+import argparse
+import array
 import binascii
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import itertools
+import logging
+import os
 import random
 import re
-import numpy
+import struct
+import sys
+import time
+
+# Debug events. They are off unless --verbose or the caller turns them on.
+log = logging.getLogger('fc')
+
+# Importing NumPy takes about a tenth of a second, which is more than pure
+# Python needs for this many bytes, or this many matrix tokens, which cost
+# far more each. Smaller jobs do without, unless something has already paid
+# for the import.
+NUMPY_MIN_SIZE = 1 << 18
+NUMPY_MIN_MATRICES = 1 << 12
+
+
+def _numpy(size, min_size=NUMPY_MIN_SIZE):
+    """Return NumPy if it is worth using on size items, or else None."""
+    if size < min_size and 'numpy' not in sys.modules:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
 
 def matmul(a, b):
     return [
@@ -53,178 +103,816 @@ def matmul(a, b):
         ]
 
 def matdiv(c, b):
-    dim = len(b), len(b[0])
-    maxv = 0
-    while True:
-        maxv += 1
-        for i in range(maxv ** 2 * dim[0] * dim[1] + 10):
-            cand = [
-                [random.randint(0, maxv) for _ in range(dim[0])]
-                for _ in range(dim[1])
-                ]
-            if matmul(cand, b) == c:
-                return cand
-
-def s_compress(plaintext):
-    """Compress the given string, returning a string."""
+    adj, det = matadj(tuple(map(tuple, b)))
+    if det == 0:
+        raise ValueError("matrix encryption key is singular")
+    # c = cand * b, so cand = c * adj(b) / det(b), which must be exact.
+    cand = matmul(c, adj)
+    if any(x % det for row in cand for x in row):
+        raise ValueError("matrix is not a multiple of the encryption key")
+    return [[x // det for x in row] for row in cand]
 
-    # Three parts of output are: HEAD, BODY, FOOT
-    head = []
-    body = []
-    foot = []
+def s_compress(plaintext, chunking='random'):
+    """Compress the given string, returning a string.
+
+    chunking picks the parts that go in the head's dictionary: 'random' ones,
+    or the most 'frequent' ones, which is slower but compresses better.
+    """
+    encryption_key, m_encryptor, l_chunks, body = _compress(
+        plaintext.encode('latin-1'), chunking)
 
+    # Three parts of output are: HEAD, BODY, FOOT
     # The first part of the HEAD is the compression version, as a simple ascii
-    # string.
-    head.append('001')
+    # string. The encryption key and the matrix encryption key follow, each
+    # ended by a slash (/), and then the dictionary.
+    # Some characters are escaped:
+    #          @ - @000
+    #  (newline) - @999
+    #          / - @998
+    l_chunks = [
+        chunk.decode('latin-1').translate(ESCAPES) for chunk in l_chunks
+        ]
+    head = ['001', encryption_key + '/', repr(m_encryptor) + '/']
+    head.extend(chunk + '/' for chunk in l_chunks)
+
+    # The sequence @005 is used to identify the 5th element of the head's
+    # dictionary, when it is put in lexicographic order.
+    ranks = _ranks(l_chunks)
+    debug = log.isEnabledFor(logging.DEBUG)
+    text = []
+    for code in body:
+        if code >= CHUNK_CODE:
+            text.append('@%03d' % (ranks[code - CHUNK_CODE] + 1))
+        elif code >= MATRIX_CODE:
+            value = code - MATRIX_CODE
+            lst1 = [[0, 0, 0], [1, 2, 3], [3, 2, 1]]
+            if value in ESCAPES:
+                lst1[0] = []
+                for c in ESCAPES[value][1:]:
+                    lst1[0].append(int(c) + 10)
+            else:
+                lst1[0][0] = value
+            if debug:
+                log.debug('matrix token %r: %r x %r', value, lst1, m_encryptor)
+            text.append('/' + repr(matmul(lst1, m_encryptor)) + '/')
+        else:
+            text.append(_TEXT_TOKENS[code])
+
+    # For better compression store a securehash of each chunk in the footer.
+    foot = s_securehash_many(
+        (chunk.encode('latin-1') for chunk in l_chunks), repeat=3)
+
+    return "\n".join(("".join(head), "".join(text), foot))
+
+
+# Body codes from _compress that are not just a byte. Four bytes of array
+# each, instead of a tuple for every token.
+MATRIX_CODE = 256
+CHUNK_CODE = 512
+
+
+def _compress(plaintext, chunking, limit=997):
+    """Do the part of compression that every file version shares.
+
+    Takes the plaintext as bytes, and returns the encryption key, the matrix
+    encryption key, the dictionary as bytes in the order it was built, and the
+    body as an array of codes: a byte of the encrypted plaintext as itself, a
+    byte for matrix compression as MATRIX_CODE plus the byte, and a reference
+    to a dictionary entry as CHUNK_CODE plus its index.
 
-    # For security purposes, next we will have an encryption key.
+    The dictionary holds at most limit entries, or any number if it is None.
+    Text files number them with three digits, and 998 and 999 are escapes.
+    """
+    if chunking not in ('random', 'frequency'):
+        raise ValueError("unknown chunking %r" % chunking)
+
+    # For security purposes, we will have an encryption key.
     # The STRONGENCRYPT algorithm developed by yours truly is used for maximum
-    # security. The encryption key is ended by a slash (/).
+    # security.
     encryption_key = random.choice((
         '!wes!', '!wesley!', '!scott!', '!wscott!', '!northbank!'
         ))
-    head.append(encryption_key + '/')
 
-    encrypted_plaintext = s_encrypt(plaintext, encryption_key)
-    print(encrypted_plaintext)
+    tokens = b_encrypt(plaintext, encryption_key)
+    log.debug('encrypted plaintext with key %r: %r', encryption_key, tokens)
 
     # For security purposes, next we will have a matrix encryption key.
     # Important letters are compressed by multiplication with this matrix
     # encryptor.
-    m_encryptor = [
-        [random.randint(1, 3) for _ in range(3)]
-        for _ in range(3)
-        ]
-    head.append(repr(m_encryptor) + '/')
+    # It has to be invertible, or nobody could ever decompress the result.
+    while True:
+        m_encryptor = [
+            [random.randint(1, 3) for _ in range(3)]
+            for _ in range(3)
+            ]
+        if matadj(tuple(map(tuple, m_encryptor)))[1] != 0:
+            break
 
     # Here is the core of the compression.
     # Extract random parts of the body and move them to the head,
     # in the form of a dictionary.
-    # The sequence @005 will be used to identify the 5th element of the head's
-    # dictionary, when it is put in lexicographic order.
-    # Some characters are escaped:
-    #          @ - @000
-    #  (newline) - @999
-    #          / - @998
-    tokens = []
-    for c in encrypted_plaintext:
-        if c == '@':
-            tokens.append('@000')
-        elif c == '\n':
-            tokens.append('@999')
-        elif c == '/':
-            tokens.append('@998')
-        else:
-            tokens.append(c)
+    # Every run that may be referenced goes in a trie, so that the longest one
+    # starting at each position can be found by walking down it.
+    trie = {}
+    if chunking == 'frequency':
+        for run in _frequent_chunks(tokens, limit):
+            _trie_insert(trie, run)
 
-    chunks = 0
     i = 0
+    body = array.array('I')
     l_chunks = []
+    entries = {}
     while i < len(tokens):
-        if chunks >= 997:
-            break
-
-        if i < len(tokens) - 5 and random.random() > 0.8:  # chunk time
+        # Any later occurrence of a run already in the head becomes a
+        # back-reference to it.
+        chunk = _trie_longest(trie, tokens, i)
+        # Once the dictionary is full the rest is left unchunked.
+        if (chunk is None and chunking == 'random'
+                and (limit is None or len(l_chunks) < limit)
+                and i < len(tokens) - 5 and random.random() > 0.8):
             chunk = tokens[i:i+5]
-            chunks += 1
-            l_chunks.append(chunk)
-            head.append("".join(chunk) + '/')
-            body.append('@' + '0' * (3 - len(str(chunks))) + str(chunks))
-            # For better compression store a securehash of the chunk in the
-            # footer.
-            foot.append(s_securehash("".join(chunk * 3)))
-            i += 4
+            _trie_insert(trie, chunk)
+
+        if chunk is not None:  # chunk time
+            if chunk not in entries:
+                entries[chunk] = len(l_chunks)
+                l_chunks.append(chunk)
+            body.append(CHUNK_CODE + entries[chunk])
+            i += len(chunk) - 1
         elif random.random() > 0.8:  # Matrix multiplication compression
-            lst1 = [[0, 0, 0], [1, 2, 3], [3, 2, 1]]
-            if tokens[i][0] == '@':
-                lst1[0] = []
-                for c in tokens[i][1:]:
-                    lst1[0].append(int(c) + 10)
-            else:
-                lst1[0][0] = ord(tokens[i])
-            print(m_encryptor, lst1)
-            body.append('/' + repr(matmul(lst1, m_encryptor)) + '/')
+            body.append(MATRIX_CODE + tokens[i])
         else:
             body.append(tokens[i])
 
         i += 1
 
-    # Next it is time to reorder the body's chunks so that they are in sorted
-    # order.
+    return encryption_key, m_encryptor, l_chunks, body
+
+
+def _ranks(l_chunks):
+    """Return the rank of each chunk once the chunks are sorted."""
     indices = sorted(enumerate(l_chunks), key=lambda x: (x[1], x[0]))
-    for i, part in enumerate(body):
-        if part[0] == '@':
-            rest = int(part[1:])
-            for cv in range(len(indices)):
-                if indices[cv][0] == rest - 1:
-                    body[i] = '@' + '0' * (3 - len(str(cv+1))) + str(cv+1)
+    ranks = [0] * len(indices)
+    for cv, (old, _) in enumerate(indices):
+        ranks[old] = cv
+    return ranks
+
+
+def _frequent_chunks(tokens, limit=997):
+    """Return the repeated runs that save the most bytes, at most limit.
+
+    A limit of None means every run that saves anything at all.
+
+    Occurrences of the 5-byte runs that repeat often enough to matter are
+    found in two passes over the tokens, without overlaps. The best runs are
+    then grown for as long as all of their occurrences agree on the next
+    byte, so that a long repeated phrase ends up as a single run.
+    """
+    def saving(length, count):
+        # Every occurrence becomes a 4 byte reference, at the price of a head
+        # entry with its slash and a 32 byte hash in the footer.
+        return count * (length - 4) - (length + 1) - 32
+
+    # A 5-byte seed needs this many occurrences before it saves anything.
+    min_count = 1
+    while saving(5, min_count) <= 0:
+        min_count += 1
+
+    # Count the windows first, in saturating byte counters indexed by a hash
+    # of the window. Windows sharing a counter only add to each other, so only
+    # those whose counter reached min_count need their positions kept, and
+    # the rest cost nothing.
+    size = len(tokens) | 1
+    counts = bytearray(size)
+    for key in _windows(tokens):
+        if counts[key % size] < 255:
+            counts[key % size] += 1
+
+    starts = {}
+    for i, key in enumerate(_windows(tokens)):
+        if counts[key % size] < min_count:
+            continue
+        found = starts.get(key)
+        if found is None:
+            starts[key] = array.array('I', (i,))
+        elif found[-1] + 5 <= i:
+            found.append(i)
+    del counts
+
+    runs = []
+    covered = bytearray(len(tokens))
+    by_saving = sorted(
+        starts, key=lambda seed: saving(5, len(starts[seed])), reverse=True)
+    for seed in by_saving:
+        found = starts[seed]
+        if len(runs) == limit or saving(5, len(found)) <= 0:
+            break
+        if covered[found[0]]:
+            continue  # just a piece of a longer run we already have
+
+        length = 5
+        while (all(p + length < len(tokens)
+                   and tokens[p + length] == tokens[found[0] + length]
+                   for p in found)
+               and all(p + length < q for p, q in zip(found, found[1:]))):
+            length += 1
+        for p in found:
+            covered[p:p + length] = b'\1' * length
+        runs.append(tokens[found[0]:found[0] + length])
+
+    return runs
+
+
+# Every run is at least this long, so the top of the trie is keyed by whole
+# prefixes of this length rather than having a level for each of their bytes.
+_RUN_PREFIX = 5
+
 
-    return "\n".join(("".join(head), "".join(body), "".join(foot)))
+def _trie_insert(trie, run):
+    node = trie.setdefault(run[:_RUN_PREFIX], {})
+    for token in run[_RUN_PREFIX:]:
+        node = node.setdefault(token, {})
+    node[None] = run
 
 
-def s_decompress(x):
+def _trie_longest(trie, tokens, i):
+    """Return the longest run in the trie that starts at tokens[i], if any."""
+    node = trie.get(tokens[i:i + _RUN_PREFIX])
+    if node is None:
+        return None
+    longest = node.get(None)
+    i += _RUN_PREFIX
+    while i < len(tokens) and tokens[i] in node:
+        node = node[tokens[i]]
+        longest = node.get(None, longest)
+        i += 1
+    return longest
+
+
+def _windows(tokens):
+    """Yield every 5-byte window of tokens, in order, as an integer."""
+    key = int.from_bytes(tokens[:4], 'big')
+    for byte in memoryview(tokens)[4:]:
+        key = (key << 8 | byte) & 0xffffffffff
+        yield key
+
+
+# Escaped characters, by their escape number.
+SPECIALS = {'000': '@', '998': '/', '999': '\n'}
+
+# The same the other way around, for str.translate, and the text form of
+# every byte.
+ESCAPES = {ord(c): '@' + num for num, c in SPECIALS.items()}
+_TEXT_TOKENS = [chr(byte).translate(ESCAPES) for byte in range(256)]
+
+# Everything in the body that is not a plain token: /[[...]]/ or @NNN.
+_BODY_TOKEN = re.compile('/(.+?)/|@([0-9]{3})')
+
+
+def s_decompress(x, jobs=1):
     version, x = int(x[:3]), x[3:]
+    if version == 2:
+        return "".join(
+            imap_blocks(s_decompress, read_blocks(io.StringIO(x)), jobs))
     head, body, foot = x.split('\n')
     key, mkey, *head = head.split('/')
-    mkey = eval(mkey)
-    chunks = r_sort(head[:-1])
-
-    def matrix_fix(lst):
-        lst = eval(lst.group(1))
-        soln = numpy.round(numpy.dot(lst, numpy.linalg.inv(mkey))).tolist()
-        print(soln)
-        if soln[0][1] == 0:
-            print(soln[0][0])
+    mkey = parse_matrix(mkey)
+    chunks = [_unescape(chunk) for chunk in r_sort(head[:-1])]
+
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    def matrix_fix(soln):
+        if debug:
+            log.debug('matrix token solved: %r', soln)
+        if soln[0][1] == 0 and 0 <= soln[0][0] < 256:
             return chr(int(soln[0][0]))
+        escape = ''.join(str(int(i)-10) for i in soln[0])
+        if escape not in SPECIALS:
+            raise ValueError("corrupt matrix")
+        return SPECIALS[escape]
+
+    # Decode the body in a single scan. Matrix tokens get a placeholder in
+    # the output for now, and are filled in together afterwards.
+    out = []
+    matrices = []
+    slots = []
+    pos = 0
+    for token in _BODY_TOKEN.finditer(body):
+        out.append(body[pos:token.start()])
+        if token.group(1) is not None:
+            slots.append(len(out))
+            matrices.append(token.group(1))
+            out.append(None)
+        elif token.group(2) in SPECIALS:
+            out.append(SPECIALS[token.group(2)])
         else:
-            return '@' + ''.join(str(int(i)-10) for i in soln[0])
+            out.append(_head_entry(chunks, token.group(2)))
+        pos = token.end()
+    out.append(body[pos:])
 
-    def replace(num):
-        num = num.group(1)
-        if num in {'000', '998', '999'}:
-            return '@' + num
+    # Every matrix token is divided by the same key, so invert it once and
+    # solve all of them with a single (N, 3, 3) multiplication.
+    if matrices:
+        if _numpy(len(matrices), NUMPY_MIN_MATRICES) is not None:
+            lst = parse_matrices(matrices)
         else:
-            return chunks[int(num)-1]
-
-    def replace_special(num):
-        num = num.group(1)
-        if num == '000':
-            return '@'
-        elif num == '998':
-            return '/'
+            lst = [parse_matrix(m) for m in matrices]
+        for slot, soln in zip(slots, matrix_solve(lst, mkey)):
+            out[slot] = matrix_fix(soln)
+
+    return s_decrypt("".join(out), key)
+
+
+def _head_entry(chunks, num):
+    """Return the head entry that a body reference @num stands for."""
+    if int(num) > len(chunks):
+        raise ValueError("reference past the end of the head")
+    return chunks[int(num)-1]
+
+
+def _unescape(chunk):
+    def special(num):
+        if num.group(1) not in SPECIALS:
+            raise ValueError("unknown escape @%s" % num.group(1))
+        return SPECIALS[num.group(1)]
+
+    return re.sub('@([0-9]{3})', special, chunk)
+
+
+def chunk_coverage(x):
+    """Return how much of the input each head entry of a .fc file covered.
+
+    This is a list of (entry, references, share) in dictionary order, where
+    share is the fraction of the whole input that the references stand for.
+    The entries of each block of a version 002 file follow one another.
+    """
+    version, x = int(x[:3]), x[3:]
+    if version == 2:
+        blocks = [
+            _block_coverage(block[3:])
+            for block in read_blocks(io.StringIO(x))
+            ]
+    else:
+        blocks = [_block_coverage(x)]
+
+    total = sum(size for _, size in blocks)
+    return [
+        (chunk, count, count * len(chunk) / total)
+        for references, _ in blocks
+        for chunk, count in references
+        ]
+
+
+def _block_coverage(x):
+    """Return the (entry, references) of a version 001 body, and its size.
+
+    The body is everything after the version, and the size is that of the
+    input it stands for.
+    """
+    head, body, foot = x.split('\n')
+    key, mkey, *head = head.split('/')
+    chunks = [_unescape(chunk) for chunk in r_sort(head[:-1])]
+
+    references = collections.Counter()
+    total = len(body)
+    for token in _BODY_TOKEN.finditer(body):
+        total -= len(token.group(0))
+        if token.group(2) is None or token.group(2) in SPECIALS:
+            total += 1
         else:
-            return '\n'
+            references[int(token.group(2))-1] += 1
+            total += len(_head_entry(chunks, token.group(2)))
 
-    body = re.sub('/(.+?)/', matrix_fix, body)
-    body = re.sub('@([0-9]{3})', replace, body)
-    body = re.sub('@([0-9]{3})', replace_special, body)
+    return [(chunk, references[i]) for i, chunk in enumerate(chunks)], total
 
-    return s_decrypt(body, key)
 
+# Version 002 files are block-framed, so that neither side ever has to hold
+# the whole file. After the version come any number of frames, each being the
+# length of a block as a decimal number, a newline, and then the block itself
+# as a complete version 001 file.
+BLOCK_SIZE = 4096
 
-class NotSortedException(Exception):
-    pass
 
+def compress_stream(infile, outfile, block_size=BLOCK_SIZE, jobs=1,
+                    chunking='random'):
+    """Compress a text stream into a version 002 .fc stream.
 
-def r_sort(lst):
-    """Return a clone of the list in sorted order."""
-    clone = lst[:]
+    Both streams should be opened with newline='' so that carriage returns in
+    the .fc data survive. Blocks are independent, so with jobs > 1 they are
+    compressed by that many worker processes.
+    """
+    outfile.write('002')
+    blocks = iter(lambda: infile.read(block_size), '')
+    compress = functools.partial(s_compress, chunking=chunking)
+    for block in imap_blocks(compress, blocks, jobs):
+        outfile.write('%d\n' % len(block))
+        outfile.write(block)
 
-    while True:
-        try:
-            random.shuffle(clone)
-            for i in range(len(clone)):
-                for j in range(len(clone)):
-                    if j > i and clone[j] < clone[i]:
-                        raise NotSortedException()
-        except:
-            pass
+
+def decompress_stream(infile, outfile, jobs=1, version=None):
+    """Decompress a version 001 or 002 .fc text stream.
+
+    With jobs > 1 the blocks of a version 002 stream are decompressed by that
+    many worker processes. Each block is still written out, in order, as soon
+    as it and all the blocks before it are done.
+
+    If the version has already been read from the stream, pass it in.
+    """
+    if version is None:
+        version = infile.read(3)
+    if version == '001':
+        outfile.write(s_decompress(version + infile.read()))
+    elif version == '002':
+        for block in imap_blocks(s_decompress, read_blocks(infile), jobs):
+            outfile.write(block)
+    else:
+        raise ValueError("unsupported version %r" % version)
+
+
+def imap_blocks(func, blocks, jobs=1):
+    """Yield func(block) for each block, in order, using jobs processes.
+
+    Only a few blocks per process are in flight at once, so memory use does
+    not depend on how many blocks there are.
+    """
+    if jobs <= 1:
+        yield from map(func, blocks)
+        return
+
+    # Reseed each worker, or they would all make the same random choices.
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=random.seed) as pool:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(pool.submit(func, block))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_blocks(infile):
+    """Yield the blocks of a version 002 stream, after its version."""
+    for size in iter(infile.readline, ''):
+        block = infile.read(int(size))
+        if len(block) != int(size):
+            raise ValueError("truncated block")
+        yield block
+
+
+# Version 003 files are binary, and block-framed like version 002. After the
+# version come any number of blocks, each being its length as a varint and
+# then:
+#
+#   the encryption key, as a varint length and its bytes
+#   the matrix encryption key, as 9 little-endian int32s
+#   the number of dictionary entries as a varint, then each entry as a varint
+#   length and its bytes, already in lexicographic order
+#   the length of the body as a varint, and the body
+#   the footer, with the raw 16 byte securehash of each entry
+#
+# Dictionary indices are varints, so unlike the text versions there is no
+# limit on the number of entries.
+#
+# The body is a sequence of varints n, each followed by whatever n & 3 says:
+# 0 is a run of n >> 2 plain bytes, 1 is a reference to dictionary entry
+# n >> 2 and 2 is a matrix of 9 little-endian int32s. Nothing is escaped.
+_MATRIX_STRUCT = struct.Struct('<9i')
+
+# Blocks can be much larger here, since the dictionary can grow with them.
+B_BLOCK_SIZE = 1 << 20
+
+
+def b_compress(plaintext, chunking='random'):
+    """Compress the given bytes into a version 003 file, returning bytes."""
+    block = _b_compress_block(plaintext, chunking)
+    return b'003' + _varint(len(block)) + block
+
+
+def b_decompress(data, jobs=1):
+    """Decompress a version 003 file given as bytes, returning bytes."""
+    out = io.BytesIO()
+    b_decompress_stream(io.BytesIO(data), out, jobs)
+    return out.getvalue()
+
+
+def b_compress_stream(infile, outfile, block_size=B_BLOCK_SIZE, jobs=1,
+                      chunking='random'):
+    """Compress a binary stream into a version 003 .fc stream."""
+    outfile.write(b'003')
+    blocks = iter(lambda: infile.read(block_size), b'')
+    compress = functools.partial(_b_compress_block, chunking=chunking)
+    for block in imap_blocks(compress, blocks, jobs):
+        outfile.write(_varint(len(block)))
+        outfile.write(block)
+
+
+def b_decompress_stream(infile, outfile, jobs=1, version=None):
+    """Decompress a version 003 .fc binary stream.
+
+    If the version has already been read from the stream, pass it in.
+    """
+    if version is None:
+        version = infile.read(3)
+    if version != b'003':
+        raise ValueError("unsupported version %r" % version)
+    for block in imap_blocks(_b_decompress_block, _read_b_blocks(infile),
+                             jobs):
+        outfile.write(block)
+
+
+def _b_compress_block(plaintext, chunking='random'):
+    encryption_key, m_encryptor, l_chunks, body = _compress(
+        plaintext, chunking, limit=None)
+
+    entries = [None] * len(l_chunks)
+    ranks = _ranks(l_chunks)
+    for old, rank in enumerate(ranks):
+        entries[rank] = l_chunks[old]
+
+    out = bytearray()
+    out += _varint(len(encryption_key)) + encryption_key.encode('latin-1')
+    out += _MATRIX_STRUCT.pack(*itertools.chain.from_iterable(m_encryptor))
+    out += _varint(len(entries))
+    for entry in entries:
+        out += _varint(len(entry)) + entry
+
+    data = bytearray()
+    for is_token, codes in itertools.groupby(
+            body, lambda code: code < MATRIX_CODE):
+        if is_token:
+            raw = bytes(codes)
+            data += _varint(len(raw) << 2) + raw
+            continue
+        for code in codes:
+            if code >= CHUNK_CODE:
+                data += _varint(ranks[code - CHUNK_CODE] << 2 | 1)
+            else:
+                lst1 = [[code - MATRIX_CODE, 0, 0], [1, 2, 3], [3, 2, 1]]
+                data += _varint(2) + _MATRIX_STRUCT.pack(
+                    *itertools.chain.from_iterable(matmul(lst1, m_encryptor)))
+    out += _varint(len(data)) + data
+
+    for entry in entries:
+        out += _cached_securehash(entry, 3)
+    return bytes(out)
+
+
+def _b_decompress_block(block):
+    buf = memoryview(block)
+    n, pos = _read_varint(buf, 0)
+    key = bytes(buf[pos:pos + n]).decode('latin-1')
+    pos += n
+    mkey = _unpack_matrix(buf, pos)
+    mkey = [mkey[0:3], mkey[3:6], mkey[6:9]]
+    pos += _MATRIX_STRUCT.size
+
+    count, pos = _read_varint(buf, pos)
+    entries = []
+    for _ in range(count):
+        n, pos = _read_varint(buf, pos)
+        entries.append(buf[pos:pos + n])
+        pos += n
+
+    size, pos = _read_varint(buf, pos)
+    end = pos + size
+    if len(buf) != end + 16 * count:
+        raise ValueError("corrupt block")
+
+    out = bytearray()
+    matrices = []
+    slots = []
+    while pos < end:
+        n, pos = _read_varint(buf, pos)
+        if n & 3 == 0:
+            out += buf[pos:pos + (n >> 2)]
+            pos += n >> 2
+        elif n & 3 == 1:
+            if n >> 2 >= count:
+                raise ValueError("reference past the end of the dictionary")
+            out += entries[n >> 2]
+        elif n & 3 == 2:
+            slots.append(len(out))
+            out.append(0)
+            matrices.append(_unpack_matrix(buf, pos))
+            pos += _MATRIX_STRUCT.size
+        else:
+            raise ValueError("corrupt block")
+
+    if matrices:
+        # Decrypting a big block loads NumPy anyway, so use it here too.
+        numpy = (_numpy(len(out))
+                 or _numpy(len(matrices), NUMPY_MIN_MATRICES))
+        if numpy is not None:
+            lst = numpy.array(matrices, dtype=numpy.int64).reshape(-1, 3, 3)
         else:
-            return clone
+            lst = [[m[0:3], m[3:6], m[6:9]] for m in matrices]
+        for slot, soln in zip(slots, matrix_solve(lst, mkey)):
+            if soln[0][1] != 0:
+                raise ValueError("corrupt matrix")
+            out[slot] = int(soln[0][0])
+
+    return b_decrypt(out, key)
+
+
+def _unpack_matrix(buf, pos):
+    if pos + _MATRIX_STRUCT.size > len(buf):
+        raise ValueError("truncated matrix")
+    return _MATRIX_STRUCT.unpack_from(buf, pos)
+
+
+def _read_b_blocks(infile):
+    while True:
+        size = _read_varint_stream(infile)
+        if size is None:
+            return
+        block = infile.read(size)
+        if len(block) != size:
+            raise ValueError("truncated block")
+        yield block
+
+
+def _varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    n = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("truncated varint")
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _read_varint_stream(infile):
+    """Read a varint from a binary stream, or return None at its end."""
+    n = shift = 0
+    while True:
+        byte = infile.read(1)
+        if not byte:
+            if shift:
+                raise ValueError("truncated varint")
+            return None
+        n |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return n
+        shift += 7
+
+
+def matrix_solve(lst, mkey):
+    """Divide a list or (N, 3, 3) array of matrix tokens by the matrix key.
+
+    Returns the solutions as lists. Many tokens are solved with a single NumPy
+    multiplication, and a few with the adjugate of the key.
+    """
+    adj, det = matadj(tuple(map(tuple, mkey)))
+    if det == 0:
+        raise ValueError("matrix encryption key is singular")
+
+    numpy = _numpy(len(lst), NUMPY_MIN_MATRICES)
+    if numpy is not None:
+        lst = numpy.asarray(lst, dtype=numpy.int64)
+        return numpy.round(numpy.matmul(lst, numpy.linalg.inv(mkey))).tolist()
+
+    return [
+        [[round(x / det) for x in row] for row in matmul(m, adj)]
+        for m in lst
+        ]
+
+
+@functools.lru_cache(maxsize=None)
+def matadj(b):
+    """Return the adjugate and determinant of a 3x3 matrix of tuples."""
+    cof = [
+        [b[(i+1)%3][(j+1)%3] * b[(i+2)%3][(j+2)%3]
+         - b[(i+1)%3][(j+2)%3] * b[(i+2)%3][(j+1)%3]
+         for j in range(3)]
+        for i in range(3)
+        ]
+    det = sum(x * y for x, y in zip(b[0], cof[0]))
+    return [list(col) for col in zip(*cof)], det
+
+
+# The fixed [[a, b, c], [d, e, f], [g, h, i]] grammar that repr produces.
+_MATRIX = re.compile(r'\[{0}, {0}, {0}\]'.format(
+    r'\[(-?[0-9]+), (-?[0-9]+), (-?[0-9]+)\]'))
+
+
+def parse_matrix(text):
+    """Parse a 3x3 integer matrix literal, as written by repr."""
+    match = _MATRIX.fullmatch(text)
+    if match is None:
+        raise ValueError("invalid matrix %r" % text)
+    values = [int(v) for v in match.groups()]
+    return [values[0:3], values[3:6], values[6:9]]
+
+
+def parse_matrices(texts):
+    """Parse a list of 3x3 matrix literals into an (N, 3, 3) integer array."""
+    import numpy
+
+    def values():
+        for text in texts:
+            match = _MATRIX.fullmatch(text)
+            if match is None:
+                raise ValueError("invalid matrix %r" % text)
+            yield from match.groups()
+
+    return numpy.fromiter(
+        map(int, values()), dtype=numpy.int64, count=9 * len(texts)
+        ).reshape(len(texts), 3, 3)
+
+
+def r_sort(lst):
+    """Return a clone of the list in sorted order."""
+    # s_compress ranks the head entries by sorting these same escaped
+    # strings, so plain sorting gives the order it numbered them in.
+    return sorted(lst)
 
 
 def s_encrypt(plaintext, key):
     """Use the STRONGENCRYPT algorithm to encrypt the plaintext."""
+    try:
+        plainbytes = plaintext.encode('latin-1')
+    except UnicodeEncodeError:
+        return _encrypt_chars(plaintext, key)
+    return b_encrypt(plainbytes, key).decode('latin-1')
+
+
+def b_encrypt(plaintext, key):
+    """Use the STRONGENCRYPT algorithm to encrypt bytes."""
+    # Same as _encrypt_chars, one array operation at a time. The plaintext is
+    # laid out in rows as long as the key, so the key just broadcasts over
+    # them, and it is widened to int16 so the differences cannot wrap around.
+    numpy = _numpy(len(plaintext))
+    if numpy is None:
+        return _b_encrypt_columns(plaintext, key)
+
+    c = _key_rows(numpy.frombuffer(plaintext, dtype=numpy.uint8), key, 0)
+    e = numpy.frombuffer(key.encode('latin-1'), dtype=numpy.uint8)
+    d = c - e.astype(numpy.int16)
+    type_a = (d < -32).view(numpy.uint8)
+    type_b = (d > 32).view(numpy.uint8)
+
+    encrypted_plaintext = numpy.empty(c.shape + (2,), dtype=numpy.uint8)
+    encrypted_plaintext[..., 0] = ord('C') - 2 * type_a - type_b
+    d = numpy.abs(d)
+    encrypted_plaintext[..., 1] = numpy.where(d > 32, d, c)
+    return encrypted_plaintext.tobytes()[:2 * len(plaintext)]
+
+
+def _b_encrypt_columns(plaintext, key):
+    """b_encrypt without NumPy, a column of bytes per key position."""
+    # Every byte under the same key byte is encrypted the same way, so each
+    # column is done by a pair of bytes.translate calls.
+    key = key.encode('latin-1')
+    step = len(key)
+    out = bytearray(2 * len(plaintext))
+    for r, e in enumerate(key):
+        types, values = _encrypt_tables(e)
+        column = plaintext[r::step]
+        out[2 * r::2 * step] = column.translate(types)
+        out[2 * r + 1::2 * step] = column.translate(values)
+    return bytes(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _encrypt_tables(e):
+    """Return the type and value translation tables for key byte e."""
+    types = bytearray(256)
+    values = bytearray(256)
+    for c in range(256):
+        if c < e - 32:
+            types[c], values[c] = ord('A'), e - c
+        elif e < c - 32:
+            types[c], values[c] = ord('B'), c - e
+        else:
+            types[c], values[c] = ord('C'), c
+    return bytes(types), bytes(values)
+
+
+def _key_rows(data, key, fill):
+    """Lay out an array as int16 rows as long as the key, padded with fill."""
+    import numpy
+
+    rows = -(-len(data) // len(key))
+    out = numpy.full(rows * len(key), fill, dtype=numpy.int16)
+    out[:len(data)] = data
+    return out.reshape(rows, len(key))
+
+
+def _encrypt_chars(plaintext, key):
+    """Use the STRONGENCRYPT algorithm, one character at a time."""
     encrypted_plaintext = []
     for i, c in enumerate(plaintext):
         e = key[i % len(key)]
@@ -243,49 +931,478 @@ def s_encrypt(plaintext, key):
 
 def s_decrypt(encrypted, key):
     """Decrypt a STRONGENCRYPTed string."""
-    plaintext = []
+    try:
+        encrypted_bytes = encrypted.encode('latin-1')
+    except UnicodeEncodeError:
+        return _decrypt_chars(encrypted, key)
+    return b_decrypt(encrypted_bytes, key).decode('latin-1')
+
+
+def b_decrypt(encrypted, key):
+    """Decrypt STRONGENCRYPTed bytes."""
+    if len(encrypted) % 2:
+        raise ValueError("encrypted data has an odd length")
+    if not key:
+        raise ValueError("empty encryption key")
+    # Even positions hold the encryption type, which tells us which way the
+    # key was applied to the byte that follows.
+    if bytes(encrypted[0::2]).translate(None, b'ABC'):
+        raise ValueError("unknown encryption type")
+
+    numpy = _numpy(len(encrypted))
+    if numpy is None:
+        return _b_decrypt_columns(encrypted, key)
+
+    encrypted = numpy.frombuffer(encrypted, dtype=numpy.uint8)
+    t = _key_rows(encrypted[0::2], key, ord('C'))
+    c = _key_rows(encrypted[1::2], key, 0)
+    k = numpy.frombuffer(key.encode('latin-1'), dtype=numpy.uint8)
+    k = k.astype(numpy.int16)
+    plaintext = numpy.where(
+        t == ord('A'), k - c, numpy.where(t == ord('B'), k + c, c))
+    if ((plaintext < 0) | (plaintext > 255)).any():
+        raise ValueError("encrypted data does not fit the key")
+    return plaintext.astype(numpy.uint8).tobytes()[:len(encrypted) // 2]
+
+
+def _b_decrypt_columns(encrypted, key):
+    """b_decrypt without NumPy, a column of bytes per key position."""
+    as_int = functools.partial(int.from_bytes, byteorder='little')
+    key = key.encode('latin-1')
+    step = len(key)
+    out = bytearray(len(encrypted) // 2)
+    for r, k in enumerate(key):
+        types = encrypted[2 * r::2 * step]
+        column = encrypted[2 * r + 1::2 * step]
+        sub, add, bad_sub, bad_add = _decrypt_tables(k)
+
+        # Each type gets its own translation of the column, and masks made
+        # from the types pick between them, a whole column at a time as big
+        # integers.
+        is_a = as_int(types.translate(_type_mask(ord('A'))))
+        is_b = as_int(types.translate(_type_mask(ord('B'))))
+        is_c = as_int(types.translate(_type_mask(ord('C'))))
+        if (as_int(column.translate(bad_sub)) & is_a
+                or as_int(column.translate(bad_add)) & is_b):
+            raise ValueError("encrypted data does not fit the key")
+        plaintext = (as_int(column.translate(sub)) & is_a
+                     | as_int(column.translate(add)) & is_b
+                     | as_int(column) & is_c)
+        out[r::step] = plaintext.to_bytes(len(column), 'little')
+    return bytes(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _decrypt_tables(k):
+    """Return the translation tables for key byte k.
 
-    while encrypted != s_encrypt("".join(plaintext), key):
-        plaintext = []
-
-        for i, c in enumerate(encrypted):
-            if i % 2 == 0:
-                continue  # even numbers are just ABC, irrelevant to encryption
-            k = key[i // 2 % len(key)]
-            possibilities = []
-            try:
-                possibilities.append(chr(ord(k) - ord(c)))
-            except:
-                pass
-            try:
-                possibilities.append(chr(ord(k) + ord(c)))
-            except:
-                pass
-            try:
-                possibilities.append(c)
-            except:
-                pass
-            plaintext.append(random.choice(possibilities))
+    These are the plaintext for type A and for type B, and then for each of
+    them a table marking the bytes that would be out of range.
+    """
+    sub = bytes((k - c) % 256 for c in range(256))
+    add = bytes((k + c) % 256 for c in range(256))
+    bad_sub = bytes(0xff if c > k else 0 for c in range(256))
+    bad_add = bytes(0xff if k + c > 255 else 0 for c in range(256))
+    return sub, add, bad_sub, bad_add
+
+
+@functools.lru_cache(maxsize=None)
+def _type_mask(t):
+    """Return a translation table that marks encryption type t."""
+    return bytes(0xff if c == t else 0 for c in range(256))
+
+
+def _decrypt_chars(encrypted, key):
+    """Decrypt a STRONGENCRYPTed string, one character at a time."""
+    if not key:
+        raise ValueError("empty encryption key")
+    plaintext = []
+    for i in range(0, len(encrypted), 2):
+        t, c = encrypted[i], encrypted[i + 1]
+        k = key[i // 2 % len(key)]
+        if t == 'A':
+            plaintext.append(chr(ord(k) - ord(c)))
+        elif t == 'B':
+            plaintext.append(chr(ord(k) + ord(c)))
+        elif t == 'C':
+            plaintext.append(c)
+        else:
+            raise ValueError("unknown encryption type %r" % t)
 
     return "".join(plaintext)
 
 
 def s_securehash(plaintext):
-    """Return a hex digest of a hash of the given string."""
-    hsh = bytearray(16)
-    plaintext = plaintext.encode('ascii')
-    hsh[15] = len(plaintext)
-    for i, byte in enumerate(plaintext):
-        hsh[i%15] ^= table[i%8][byte]
+    """Return a hex digest of a hash of the given string or bytes."""
+    if isinstance(plaintext, str):
+        plaintext = plaintext.encode('latin-1')
+    hsh = _cached_securehash(bytes(plaintext))
     return binascii.hexlify(hsh).decode('ascii')
 
 
-### GENERATE THE SECUREHASH TABLE ###
+def s_securehash_many(chunks, repeat=1):
+    """Return the hex digests of many chunks of bytes, concatenated.
+
+    Each chunk is hashed as if it were repeated the given number of times,
+    without actually building the repeated copy.
+    """
+    return binascii.hexlify(
+        b"".join(_cached_securehash(bytes(chunk), repeat) for chunk in chunks)
+        ).decode('ascii')
+
+
+def _securehash(data, repeat=1):
+    hsh = bytearray(16)
+    hsh[15] = len(data) * repeat % 256
+    for k in range(repeat):
+        start = k * len(data)
+        if len(data) < 32:
+            for i, byte in enumerate(data, start):
+                hsh[i%15] ^= table[i%8 << 8 | byte]
+        else:
+            for i, byte in enumerate(_securehash_fold(data, start), start):
+                hsh[i%15] ^= byte
+    return bytes(hsh)
+
+
+def _securehash_fold(data, start):
+    """Return the 15 table bytes of data XORed together by hash position.
+
+    data is taken to start at position start, and byte t of the result goes
+    to position (start + t) % 15 of the hash.
+    """
+    # Look each byte up in the table row for its position, with one
+    # bytes.translate for each of the 8 rows.
+    hashed = bytearray(len(data))
+    for r in range(8):
+        row = (start + r) % 8
+        hashed[r::8] = data[r::8].translate(table[row << 8:row + 1 << 8])
+
+    # Then XOR the 15-byte blocks together as one big integer, folding it in
+    # half until one block is left. The zero padding changes nothing.
+    blocks = 1
+    while blocks * 15 < len(data):
+        blocks *= 2
+    x = int.from_bytes(hashed + bytes(blocks * 15 - len(data)), 'little')
+    bits = blocks * 120
+    while bits > 120:
+        bits //= 2
+        x = (x >> bits) ^ (x & ((1 << bits) - 1))
+    return x.to_bytes(15, 'little')
+
+
+# Real text repeats itself, so the same chunks come up again and again.
+SECUREHASH_CACHE_SIZE = 4096
+
+
+def set_securehash_cache_size(maxsize=SECUREHASH_CACHE_SIZE):
+    """Resize the securehash cache, emptying it.
+
+    A maxsize of None means unbounded, and 0 turns the cache off.
+    """
+    global _cached_securehash
+    _cached_securehash = functools.lru_cache(maxsize)(_securehash)
+
+
+def securehash_cache_info():
+    """Return the hit, miss and size counters of the securehash cache."""
+    return _cached_securehash.cache_info()
+
+
+set_securehash_cache_size()
+
+
+### THE SECUREHASH TABLE ###
+
+# One row of 256 bytes for each of the 8 positions, so byte b at position i
+# hashes to table[i % 8 * 256 + b]. It is spelled out in full so that importing
+# fc does not have to build it; _make_table is how it was made.
+table = bytes.fromhex("""
+    fffc0502f3f0f9f617141d1a0b08110ecfccd5d2c3c0c9c6e7e4edeadbd8e1de
+    5f5c65625350595677747d7a6b68716e2f2c35322320292647444d4a3b38413e
+    3f3c45423330393657545d5a4b48514e0f0c15120300090627242d2a1b18211e
+    9f9ca5a293909996b7b4bdbaaba8b1ae6f6c75726360696687848d8a7b78817e
+    7f7c85827370797697949d9a8b88918e4f4c55524340494667646d6a5b58615e
+    dfdce5e2d3d0d9d6f7f4fdfaebe8f1eeafacb5b2a3a0a9a6c7c4cdcabbb8c1be
+    bfbcc5c2b3b0b9b6d7d4dddacbc8d1ce8f8c959283808986a7a4adaa9b98a19e
+    1f1c25221310191637343d3a2b28312eefecf5f2e3e0e9e607040d0afbf801fe
+
+    2926302d1b18221f45424c4937343e3bf1eef8f5e3e0eae70d0a1411fffc0603
+    9996a09d8b88928fb5b2bcb9a7a4aeab615e686553505a577d7a84816f6c7673
+    4946504d3b38423f65626c6957545e5b110e181503000a072d2a34311f1c2623
+    b9b6c0bdaba8b2afd5d2dcd9c7c4cecb817e888573707a779d9aa4a18f8c9693
+    e9e6f0eddbd8e2df05020c09f7f4fefbb1aeb8b5a3a0aaa7cdcad4d1bfbcc6c3
+    5956605d4b48524f75727c7967646e6b211e282513101a173d3a44412f2c3633
+    0906100dfbf802ff25222c2917141e1bd1ced8d5c3c0cac7edeaf4f1dfdce6e3
+    7976807d6b68726f95929c9987848e8b413e484533303a375d5a64614f4c5653
+
+    beb9c8c3a9a4b3aee8e3f2edd3ceddd86a65746f55505f5a948f9e997f7a8984
+    6661706b514c5b56908b9a957b768580120d1c17fdf807023c3746412722312c
+    6e6978735954635e9893a29d837e8d881a15241f05000f0a443f4e492f2a3934
+    1611201b01fc0b06403b4a452b263530c2bdccc7ada8b7b2ece7f6f1d7d2e1dc
+    5e5968634944534e8883928d736e7d780a05140ff5f0fffa342f3e391f1a2924
+    0601100bf1ecfbf6302b3a351b162520b2adbcb79d98a7a2dcd7e6e1c7c2d1cc
+    0e091813f9f403fe3833423d231e2d28bab5c4bfa5a0afaae4dfeee9cfcad9d4
+    b6b1c0bba19caba6e0dbeae5cbc6d5d0625d6c674d4857528c8796917772817c
+
+    07fe1910e3daf5ec504762592c233e35756c877e5148635abeb5d0c79a91aca3
+    2b223d3407fe1910746b867d504762599990aba2756c877ee2d9f4ebbeb5d0c7
+    bfb6d1c89b92ada408ff1a11e4dbf6ed2d243f3609001b12766d887f5249645b
+    e3daf5ecbfb6d1c82c233e3508ff1a115148635a2d243f369a91aca3766d887f
+    978ea9a0736a857ce0d7f2e9bcb3cec505fc170ee1d8f3ea4e4560572a213c33
+    bbb2cdc4978ea9a004fb160de0d7f2e929203b3205fc170e7269847b4e456057
+    4f4661582b223d34988faaa1746b867dbdb4cfc69990aba206fd180fe2d9f4eb
+    736a857c4f466158bcb3cec5988faaa1e1d8f3eabdb4cfc62a213c3306fd180f
+
+    aa99ccbb6655887732215443eedd10ff9988bbaa5544776621104332ddccffee
+    ccbbeedd8877aa995443766510ff3221bbaaddcc7766998843326554ffee2110
+    6655887722114433eedd10ffaa99ccbb5544776611003322ddccffee9988bbaa
+    8877aa994433665510ff3221ccbbeedd7766998833225544ffee2110bbaaddcc
+    32215443eedd10ffbaa9dccb7665988721104332ddccffeea998cbba65548776
+    5443766510ff3221dccbfeed9887baa943326554ffee2110cbbaeddc8776a998
+    eedd10ffaa99ccbb7665988732215443ddccffee9988bbaa6554877621104332
+    10ff3221ccbbeedd9887baa954437665ffee2110bbaaddcc8776a99843326554
+
+    f7d639187352b594ffde41207b5abd9ce7c629086342a584efce31106b4aad8c
+    18f75a399473d6b520ff62419c7bdebd08e74a298463c6a510ef52318c6bcead
+    b594f7d631107352bd9cffde39187b5aa584e7c621006342ad8cefce29086b4a
+    d6b518f752319473debd20ff5a399c7bc6a508e742218463cead10ef4a298c6b
+    7b5abd9cf7d639188362c5a4ffde41206b4aad8ce7c629087352b594efce3110
+    9c7bdebd18f75a39a483e6c520ff62418c6bcead08e74a299473d6b510ef5231
+    39187b5ab594f7d641208362bd9cffde29086b4aa584e7c631107352ad8cefce
+    5a399c7bd6b518f76241a483debd20ff4a298c6bc6a508e752319473cead10ef
 
-table = [{} for _ in range(8)]
+    965518d7925114d39e5d20df9a591cdb864508c7824104c38e4d10cf8a490ccb
+    b67538f7b27134f3be7d40ffba793cfba66528e7a26124e3ae6d30efaa692ceb
+    5514d7965110d3925d1cdf9e5918db9a4504c7864100c3824d0ccf8e4908cb8a
+    7534f7b67130f3b27d3cffbe7938fbba6524e7a66120e3a26d2cefae6928ebaa
+    18d79a5914d3965520dfa2611cdb9e5d08c78a4904c3864510cf92510ccb8e4d
+    38f7ba7934f3b67540ffc2813cfbbe7d28e7aa6924e3a66530efb2712cebae6d
+    d7965918d3925514df9e6120db9a5d1cc7864908c3824504cf8e5110cb8a4d0c
+    f7b67938f3b27534ffbe8140fbba7d3ce7a66928e3a26524efae7130ebaa6d2c
 
-for byte in range(32, 128):
+    d554d756d150d352dd5cdf5ed958db5ac544c746c140c342cd4ccf4ec948cb4a
+    f574f776f170f372fd7cff7ef978fb7ae564e766e160e362ed6cef6ee968eb6a
+    95149716911093129d1c9f1e99189b1a85048706810083028d0c8f0e89088b0a
+    b534b736b130b332bd3cbf3eb938bb3aa524a726a120a322ad2caf2ea928ab2a
+    56d558d752d154d35edd60df5ad95cdb46c548c742c144c34ecd50cf4ac94ccb
+    76f578f772f174f37efd80ff7af97cfb66e568e762e164e36eed70ef6ae96ceb
+    16951897129114931e9d209f1a991c9b06850887028104830e8d108f0a890c8b
+    36b538b732b134b33ebd40bf3ab93cbb26a528a722a124a32ead30af2aa92cab
+""")
+
+
+def _make_table():
+    """Build the securehash table from scratch."""
+    out = bytearray(8 * 256)
     for i in range(8):
-        b = byte ^ 0x55
-        result = (b + (b << i) + (b >> i)) % 256
-        table[i][byte] = result
+        for byte in range(256):
+            b = byte ^ 0x55
+            out[i * 256 + byte] = (b + (b << i) + (b >> i)) % 256
+    return bytes(out)
+
+
+def compress_many(paths, jobs=1, chunking='random', binary=False,
+                  force=False):
+    """Compress each of the paths to path + '.fc', all in one process pool.
+
+    Yields (path, seconds, size, compressed size, error) for each path, in
+    order, where error is whatever stopped that file, or None. The files are
+    shared out whole between the jobs, so they share the interpreter, NumPy
+    and the securehash cache.
+    """
+    compress = functools.partial(
+        _compress_file, chunking=chunking, binary=binary, force=force)
+    return imap_blocks(compress, paths, jobs)
+
+
+def _compress_file(path, chunking='random', binary=False, force=False):
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f, _output(path + '.fc', force) as k:
+            _filter(f, k, True, binary=binary, chunking=chunking)
+            size, compressed = f.tell(), k.tell()
+    except (OSError, ValueError) as e:
+        return path, time.perf_counter() - start, 0, 0, e
+    return path, time.perf_counter() - start, size, compressed, None
+
+
+@contextlib.contextmanager
+def _text_stream(stream):
+    """Wrap a binary stream for the text format, leaving it open afterwards."""
+    text = io.TextIOWrapper(stream, encoding='latin-1', newline='')
+    try:
+        yield text
+    finally:
+        text.flush()
+        text.detach()
+
+
+@contextlib.contextmanager
+def _output(outpath, force=False):
+    """Open outpath for writing, or stdout for -, and clean up on failure."""
+    if outpath == '-':
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+
+    try:
+        outfile = open(outpath, 'wb' if force else 'xb')
+    except FileExistsError:
+        raise FileExistsError(
+            "%s already exists, use --force to overwrite it"
+            % outpath) from None
+    # Never leave half an output file behind.
+    try:
+        with outfile:
+            yield outfile
+    except BaseException:
+        os.remove(outpath)
+        raise
+
+
+def _filter(infile, outfile, compress, binary=False, jobs=1,
+            chunking='random'):
+    """Compress or decompress one binary stream into another."""
+    if compress and binary:
+        b_compress_stream(infile, outfile, jobs=jobs, chunking=chunking)
+        return
+    if compress:
+        with _text_stream(infile) as f, _text_stream(outfile) as k:
+            compress_stream(f, k, jobs=jobs, chunking=chunking)
+        return
+
+    # The version in the first three bytes says which format this is. A pipe
+    # may hand them over one at a time, so read rather than peek.
+    version = infile.read(3)
+    if version == b'003':
+        b_decompress_stream(infile, outfile, jobs=jobs, version=version)
+    else:
+        with _text_stream(infile) as f, _text_stream(outfile) as k:
+            decompress_stream(f, k, jobs=jobs,
+                              version=version.decode('latin-1'))
+
+
+def _find_files(paths, compress):
+    """Yield the paths, with the files to work on inside any directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.fc') != compress:
+                    yield os.path.join(root, name)
+
+
+def _main_file(path, args):
+    """Compress or decompress one of the files given on the command line."""
+    if path == '-':
+        outpath = '-'
+    elif args.compress:
+        outpath = path + '.fc'
+    elif path.endswith('.fc'):
+        outpath = path[:-3]
+    else:
+        raise ValueError("unknown suffix, ignored")
+
+    with contextlib.ExitStack() as stack:
+        if path == '-':
+            infile = sys.stdin.buffer
+        else:
+            infile = stack.enter_context(open(path, 'rb'))
+        outfile = stack.enter_context(_output(outpath, args.force))
+        _filter(infile, outfile, args.compress, binary=args.binary,
+                jobs=args.jobs, chunking=args.chunking)
+
+
+def _main_done(path, args):
+    """Finish off a file once it has been compressed or decompressed."""
+    if args.compress and args.coverage:
+        with open(path + '.fc', encoding='latin-1', newline='') as f:
+            for chunk, references, share in chunk_coverage(f.read()):
+                print('%7.3f%% %6d  %r' % (share * 100, references, chunk))
+    if path != '-' and not args.keep:
+        os.remove(path)
+
+
+def main(argv=None):
+    """Run the fc command line, and return its exit status."""
+    parser = argparse.ArgumentParser(prog='fc',
+                                     description='Compress quickly.')
+    parser.add_argument('--compress', dest='compress', action='store_const',
+                       const=True, default=False)
+    parser.add_argument('--decompress', dest='compress', action='store_const',
+                       const=False, default=True)
+    parser.add_argument('files', nargs='*', default=['-'], metavar='file',
+                        help='files to work on, or - for stdin and stdout '
+                             '(the default)')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='work on the files inside directories')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='keep the input files')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='overwrite existing output files')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of blocks to process in parallel, or '
+                             'of files when compressing several')
+    parser.add_argument('--chunking', choices=('random', 'frequency'),
+                        default='random',
+                        help='how to pick the dictionary chunks')
+    parser.add_argument('--binary', action='store_true',
+                        help='write the binary format')
+    parser.add_argument('--coverage', action='store_true',
+                        help='show how much of the input each chunk covered')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log debug events to stderr')
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG,
+                            format='%(name)s: %(message)s')
+    if args.binary and args.coverage:
+        parser.error('--coverage only works with the text format')
+    if args.coverage and (not args.compress or '-' in args.files):
+        parser.error('--coverage needs files to compress')
+
+    paths = args.files
+    if args.recursive:
+        paths = list(_find_files(paths, args.compress))
+
+    status = 0
+    if len(paths) > 1 and args.compress and '-' not in paths:
+        # Many files share one pool, and get a report at the end.
+        report = []
+        for path, seconds, size, compressed, error in compress_many(
+                paths, jobs=args.jobs, chunking=args.chunking,
+                binary=args.binary, force=args.force):
+            if error is not None:
+                print('fc: %s: %s' % (path, error), file=sys.stderr)
+                status = 1
+                continue
+            _main_done(path, args)
+            report.append((path, seconds, size, compressed))
+
+        print('%9s %12s %12s  %s' % ('seconds', 'size', 'compressed', 'file'),
+              file=sys.stderr)
+        for path, seconds, size, compressed in report:
+            print('%9.3f %12d %12d  %s' % (seconds, size, compressed, path),
+                  file=sys.stderr)
+        print('%9.3f %12d %12d  total of %d files' % (
+            sum(r[1] for r in report), sum(r[2] for r in report),
+            sum(r[3] for r in report), len(report)), file=sys.stderr)
+        return status
+
+    for path in paths:
+        try:
+            _main_file(path, args)
+        except (OSError, ValueError) as e:
+            print('fc: %s: %s' % (path, e), file=sys.stderr)
+            status = 1
+            continue
+        _main_done(path, args)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())